@@ -1,26 +1,55 @@
 import streamlit as st
-import json, random, unicodedata
+import json, os, random, sys
 from dataclasses import dataclass, field
+from itertools import product
 from typing import List, Dict, Optional
 from pathlib import Path
+from uuid import uuid4
 import pandas as pd
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def json_loads(raw: bytes):
+    return orjson.loads(raw) if orjson is not None else json.loads(raw)
+
+def json_dumps(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
 st.set_page_config(page_title="Italiano: epäsäännölliset verbit", page_icon="🇮🇹", layout="centered")
 
 DATA_FILE = Path("verbs.json")
 PROGRESS_FILE = Path("progress.json")
 
-PERSONS = ["io","tu","lui/lei","noi","voi","loro"]
-IMPERATIVE_PERSONS = ["tu","noi","voi"]
-TENSES_ALL = ["presente","imperfetto","passato_prossimo","imperativo"]
+# interned so the tense/person strings shared by every Card hash and
+# compare by identity
+PERSONS = [sys.intern(p) for p in ("io","tu","lui/lei","noi","voi","loro")]
+IMPERATIVE_PERSONS = [sys.intern(p) for p in ("tu","noi","voi")]
+TENSES_ALL = [sys.intern(t) for t in ("presente","imperfetto","passato_prossimo","imperativo")]
 
-def normalize(s: str) -> str:
-    s = s.strip().lower()
-    s = ''.join(c for c in unicodedata.normalize('NFD', s)
-                if unicodedata.category(c) != 'Mn')
-    return s
+# sampling weight per Leitner box, indexed by box number (index 0 unused)
+_BOX_WEIGHTS = (0, 6, 4, 2, 1, 1)
 
-@dataclass
+# accent-stripping table: maps accented vowels to their base letter in one
+# C-level translate call instead of a per-character NFD loop
+ACCENT_TABLE = str.maketrans({ord(c): ord(b) for c, b in [
+    ('à','a'),('á','a'),('è','e'),('é','e'),('ì','i'),('í','i'),('î','i'),
+    ('ò','o'),('ó','o'),('ù','u'),('ú','u')
+]})
+
+def normalize(s: str) -> str:
+    s = s.strip().casefold()
+    if s.isascii():
+        # quick check: nothing to strip in pure-ASCII input, which is what
+        # most typed answers are
+        return s
+    return s.translate(ACCENT_TABLE)
+
+@dataclass(slots=True)
 class Verb:
     infinitive: str
     translation_fi: str
@@ -30,6 +59,8 @@ class Verb:
     past_participle: str
     imperative: Dict[str,str]
     irregular_imperfect: Optional[List[str]] = None
+    _imperfect_cache: Optional[List[str]] = field(default=None, repr=False)
+    _passato_cache: Optional[List[str]] = field(default=None, repr=False)
 
     @staticmethod
     def from_dict(d: dict) -> "Verb":
@@ -45,6 +76,11 @@ class Verb:
         )
 
     def imperfect(self) -> List[str]:
+        if self._imperfect_cache is None:
+            self._imperfect_cache = self._build_imperfect()
+        return self._imperfect_cache
+
+    def _build_imperfect(self) -> List[str]:
         if self.irregular_imperfect:
             return self.irregular_imperfect
         if not self.noi_present.endswith("iamo"):
@@ -58,75 +94,92 @@ class Verb:
             base = "dice"
         return [base + e for e in endings]
 
+    def passato_prossimo(self) -> List[str]:
+        if self._passato_cache is None:
+            aux = (["sono","sei","è","siamo","siete","sono"]
+                   if self.auxiliary == "essere"
+                   else ["ho","hai","ha","abbiamo","avete","hanno"])
+            self._passato_cache = [a + " " + self.past_participle for a in aux]
+        return self._passato_cache
+
     def present_for(self, person_idx: int) -> str:
         return self.present[person_idx]
 
     def imperative_for(self, person_label: str) -> str:
         return self.imperative[person_label]
 
-@dataclass
+@dataclass(slots=True, frozen=True)
 class Card:
     verb: Verb
     tense: str
     person_idx: Optional[int] = None
     person_label: Optional[str] = None
+    key: str = ""  # precomputed progress key, set in make_cards
+    id: int = -1   # position in the make_cards list, set in make_cards
 
 @dataclass
 class Progress:
     boxes: Dict[str, int] = field(default_factory=dict)
+    # flat per-card box array indexed by Card.id; boxes stays the
+    # persisted source of truth, the array is the hot-path view of it
+    _arr: bytearray = field(default_factory=bytearray, repr=False)
 
     def key(self, c: Card) -> str:
-        if c.tense == "imperativo":
-            pk = c.person_label
-        else:
-            pk = PERSONS[c.person_idx]  # type: ignore
-        return f"{c.verb.infinitive}|{c.tense}|{pk}"
+        return c.key
+
+    def attach(self, cards: List[Card]):
+        self._arr = bytearray(self.boxes.get(c.key, 1) for c in cards)
 
     def get_box(self, c: Card) -> int:
-        return self.boxes.get(self.key(c), 1)
+        if 0 <= c.id < len(self._arr):
+            return self._arr[c.id]
+        return self.boxes.get(c.key, 1)
 
     def update(self, c: Card, correct: bool):
-        k = self.key(c)
-        cur = self.boxes.get(k, 1)
-        if correct:
-            self.boxes[k] = min(5, cur + 1)
-        else:
-            self.boxes[k] = 1
+        new = min(5, self.get_box(c) + 1) if correct else 1
+        if 0 <= c.id < len(self._arr):
+            self._arr[c.id] = new
+        self.boxes[c.key] = new
 
+@st.cache_data(show_spinner=False)
 def load_data() -> List[Verb]:
     if not DATA_FILE.exists():
         st.error("verbs.json ei löytynyt. Lataa samaan kansioon kuin tämä sovellus.")
         st.stop()
-    with open(DATA_FILE, "r", encoding="utf-8") as f:
-        data = json.load(f)
+    data = json_loads(DATA_FILE.read_bytes())
     return [Verb.from_dict(d) for d in data]
 
 def load_progress() -> Progress:
     try:
         if PROGRESS_FILE.exists():
-            with open(PROGRESS_FILE, "r", encoding="utf-8") as f:
-                return Progress(**json.load(f))
+            return Progress(**json_loads(PROGRESS_FILE.read_bytes()))
     except Exception:
         pass
     return Progress()
 
 def save_progress(p: Progress):
     try:
-        with open(PROGRESS_FILE, "w", encoding="utf-8") as f:
-            json.dump({"boxes": p.boxes}, f, ensure_ascii=False, indent=2)
+        state = hash(frozenset(p.boxes.items()))
+        if st.session_state.get("progress_saved_hash") == state:
+            return  # nothing changed since the last save
+        tmp = PROGRESS_FILE.with_suffix(".json.tmp")
+        tmp.write_bytes(json_dumps({"boxes": p.boxes}))
+        os.replace(tmp, PROGRESS_FILE)
+        st.session_state.progress_saved_hash = state
     except Exception as e:
         st.warning(f"Edistymistä ei voitu tallentaa: {e}")
 
-def make_cards(verbs: List[Verb], tenses: List[str]) -> List[Card]:
-    cards = []
-    for v in verbs:
-        for t in tenses:
-            if t == "imperativo":
-                for lbl in IMPERATIVE_PERSONS:
-                    cards.append(Card(verb=v, tense=t, person_label=lbl))
-            else:
-                for i in range(6):
-                    cards.append(Card(verb=v, tense=t, person_idx=i))
+@st.cache_data(show_spinner=False)
+def make_cards(verbs: List[Verb], tenses: tuple) -> List[Card]:
+    non_imp = [t for t in tenses if t != "imperativo"]
+    cards = [Card(verb=v, tense=t, person_idx=i, id=n,
+                  key="|".join((v.infinitive, t, PERSONS[i])))
+             for n, (v, t, i) in enumerate(product(verbs, non_imp, range(6)))]
+    if "imperativo" in tenses:
+        base = len(cards)
+        cards += [Card(verb=v, tense="imperativo", person_label=lbl, id=base + n,
+                       key="|".join((v.infinitive, "imperativo", lbl)))
+                  for n, (v, lbl) in enumerate(product(verbs, IMPERATIVE_PERSONS))]
     return cards
 
 def expected_form(card: Card) -> str:
@@ -136,37 +189,39 @@ def expected_form(card: Card) -> str:
     if card.tense == "imperfetto":
         return v.imperfect()[card.person_idx]  # type: ignore
     if card.tense == "passato_prossimo":
-        aux = "sono" if v.auxiliary == "essere" else "ho"
-        io = aux + " " + v.past_participle
-        forms = [
-            io,
-            ("sei" if v.auxiliary=="essere" else "hai") + " " + v.past_participle,
-            ("è"  if v.auxiliary=="essere" else "ha")  + " " + v.past_participle,
-            ("siamo" if v.auxiliary=="essere" else "abbiamo") + " " + v.past_participle,
-            ("siete" if v.auxiliary=="essere" else "avete") + " " + v.past_participle,
-            ("sono" if v.auxiliary=="essere" else "hanno") + " " + v.past_participle
-        ]
-        return forms[card.person_idx]  # type: ignore
+        return v.passato_prossimo()[card.person_idx]  # type: ignore
     if card.tense == "imperativo":
         return v.imperative_for(card.person_label)  # type: ignore
     raise ValueError("tuntematon aikamuoto")
 
+@st.cache_data(show_spinner=False)
+def pools_by_tense(verbs: List[Verb], tenses: tuple) -> Dict[str, List[tuple]]:
+    # per-tense distractor pools; forms are paired with their normalized
+    # spelling so the distractor filter doesn't have to re-normalize them
+    pools: Dict[str, List[tuple]] = {t: [] for t in tenses}
+    for c in make_cards(verbs, tenses):
+        try:
+            form = expected_form(c)
+        except Exception:
+            continue
+        pools[c.tense].append((form, normalize(form)))
+    return pools
+
 def pick_due_cards(cards: List[Card], prog: Progress, n: int) -> List[Card]:
-    weighted = []
-    for c in cards:
-        box = prog.get_box(c)
-        weight = {1:6, 2:4, 3:2, 4:1, 5:1}[box]
-        weighted.extend([c]*weight)
-    random.shuffle(weighted)
+    if not cards:
+        return []
+    prog.attach(cards)
+    weights = [_BOX_WEIGHTS[prog.get_box(c)] for c in cards]
     seen = set()
     out = []
-    for c in weighted:
-        k = (c.verb.infinitive, c.tense, c.person_idx, c.person_label)
-        if k not in seen:
-            out.append(c)
-            seen.add(k)
-        if len(out) >= n:
-            break
+    target = min(n, len(cards))
+    while len(out) < target:
+        for c in random.choices(cards, weights=weights, k=min(64, len(cards))):
+            if c.key not in seen:
+                seen.add(c.key)
+                out.append(c)
+                if len(out) >= target:
+                    break
     return out
 
 # ----- Load verbs & progress -----
@@ -233,11 +288,6 @@ if "correct_count" not in st.session_state:
     st.session_state.correct_count = 0
 if "finished" not in st.session_state:
     st.session_state.finished = False
-if "current_set" not in st.session_state:
-    st.session_state.current_set = pick_due_cards(make_cards(selected_verbs, chosen_tenses),
-                                                  st.session_state.progress, n_questions)
-if "selection_sig" not in st.session_state:
-    st.session_state.selection_sig = sig_now
 if "show_hint" not in st.session_state:
     st.session_state.show_hint = False
 if "checked" not in st.session_state:
@@ -246,14 +296,11 @@ if "was_correct" not in st.session_state:
     st.session_state.was_correct = False
 if "last_correct_form" not in st.session_state:
     st.session_state.last_correct_form = ""
-if "mc_options" not in st.session_state:
-    st.session_state.mc_options = None
-if "mc_for_idx" not in st.session_state:
-    st.session_state.mc_for_idx = None
 
-# --- auto rebuild if selection changed ---
+# --- the round set is sampled only here: on first load and when the
+#     verb/tense/length selection changes, never on ordinary reruns ---
 def rebuild_current_set():
-    st.session_state.current_set = pick_due_cards(make_cards(selected_verbs, chosen_tenses),
+    st.session_state.current_set = pick_due_cards(make_cards(selected_verbs, tuple(chosen_tenses)),
                                                   st.session_state.progress, n_questions)
     st.session_state.idx = 0
     st.session_state.correct_count = 0
@@ -261,31 +308,57 @@ def rebuild_current_set():
     st.session_state.show_hint = False
     st.session_state.checked = False
     st.session_state.last_correct_form = ""
-    st.session_state.mc_options = None
-    st.session_state.mc_for_idx = None
+    st.session_state.round_id = uuid4().hex
     if "mc_choice" in st.session_state:
         st.session_state.pop("mc_choice")
 
-if st.session_state.selection_sig != sig_now:
-    rebuild_current_set()
-    st.session_state.selection_sig = sig_now
+def request_restart():
+    # callbacks run before the script body in a fresh __main__, where
+    # cache_data can't unpickle Card — so only flag the restart here and
+    # let the script body below do the actual rebuild
+    st.session_state.restart_requested = True
 
-def restart_round():
+restart_requested = st.session_state.pop("restart_requested", False)
+if ("current_set" not in st.session_state
+        or restart_requested
+        or st.session_state.get("selection_sig") != sig_now):
     rebuild_current_set()
-    st.rerun()
+    st.session_state.selection_sig = sig_now
 
 def go_next():
     st.session_state.idx += 1
     st.session_state.show_hint = False
     st.session_state.checked = False
     st.session_state.last_correct_form = ""
-    st.session_state.mc_options = None
-    st.session_state.mc_for_idx = None
     if "mc_choice" in st.session_state:
         st.session_state.pop("mc_choice")
     if st.session_state.idx >= len(st.session_state.current_set):
         st.session_state.finished = True
-    st.rerun()
+
+def skip_card(c: Card):
+    st.session_state.progress.update(c, False)
+    save_progress(st.session_state.progress)
+    go_next()
+
+def record_answer(c: Card, correct_form: str, is_ok: bool):
+    st.session_state.was_correct = is_ok
+    st.session_state.last_correct_form = correct_form
+    st.session_state.progress.update(c, is_ok)
+    save_progress(st.session_state.progress)
+    st.session_state.checked = True
+    if is_ok:
+        st.session_state.correct_count += 1
+
+def check_written(c: Card, correct_form: str):
+    user_input = st.session_state.get(f"in_{st.session_state.idx}", "")
+    record_answer(c, correct_form, normalize(user_input) == normalize(correct_form))
+
+def check_choice(c: Card, correct_form: str):
+    pick = st.session_state.get("mc_choice")
+    if pick is None:
+        st.session_state.mc_warning = True
+        return
+    record_answer(c, correct_form, normalize(pick) == normalize(correct_form))
 
 # --- Visible progress in sidebar ---
 with st.sidebar:
@@ -309,13 +382,11 @@ with st.sidebar:
     st.bar_chart(df_counts)
 
 # Restart when settings change
-if st.button("Aloita kierros uusilla asetuksilla"):
-    restart_round()
+st.button("Aloita kierros uusilla asetuksilla", on_click=request_restart)
 
 if st.session_state.finished:
     st.success(f"Valmis! Oikein {st.session_state.correct_count}/{len(st.session_state.current_set)}.")
-    if st.button("Uusi kierros"):
-        restart_round()
+    st.button("Uusi kierros", on_click=request_restart)
     st.stop()
 
 if not st.session_state.current_set:
@@ -341,7 +412,7 @@ with col1:
 correct = expected_form(card)
 
 if mode == "Kirjoitusharjoitus":
-    user_input = st.text_input("Kirjoita oikea muoto", key=f"in_{st.session_state.idx}")
+    st.text_input("Kirjoita oikea muoto", key=f"in_{st.session_state.idx}")
 
     if st.session_state.checked:
         if st.session_state.was_correct:
@@ -351,56 +422,32 @@ if mode == "Kirjoitusharjoitus":
 
         c1, c2 = st.columns(2)
         with c1:
-            if st.button("Seuraava"):
-                go_next()
+            st.button("Seuraava", on_click=go_next)
         with c2:
-            if st.button("Ohita tämäkin"):
-                st.session_state.progress.update(card, False)
-                save_progress(st.session_state.progress)
-                go_next()
+            st.button("Ohita tämäkin", on_click=skip_card, args=(card,))
 
     else:
         c1, c2 = st.columns(2)
         with c1:
-            if st.button("Tarkista"):
-                is_ok = normalize(user_input) == normalize(correct)
-                st.session_state.was_correct = is_ok
-                st.session_state.last_correct_form = correct
-                st.session_state.progress.update(card, is_ok)
-                save_progress(st.session_state.progress)
-                st.session_state.checked = True
-                if is_ok:
-                    st.session_state.correct_count += 1
+            st.button("Tarkista", on_click=check_written, args=(card, correct))
         with c2:
-            if st.button("Ohita"):
-                st.session_state.progress.update(card, False)
-                save_progress(st.session_state.progress)
-                go_next()
+            st.button("Ohita", on_click=skip_card, args=(card,))
 
 else:  # Monivalinta
-    if st.session_state.mc_options is None or st.session_state.mc_for_idx != st.session_state.idx:
-        options = {correct}
-        pool = []
-        for d in make_cards(selected_verbs, TENSES_ALL):
-            try:
-                pool.append(expected_form(d))
-            except Exception:
-                pass
-        random.shuffle(pool)
-        for form in pool:
-            if len(options) >= 4:
-                break
-            if normalize(form) != normalize(correct):
-                options.add(form)
-        opts = list(options)
-        random.shuffle(opts)
-        st.session_state.mc_options = opts
-        st.session_state.mc_for_idx = st.session_state.idx
-        if "mc_choice" in st.session_state:
-            st.session_state.pop("mc_choice")
-
-    opts = st.session_state.mc_options
-    choice = st.radio("Valitse oikea muoto", opts, index=None, key="mc_choice")
+    # deterministic per (card, round): the same options come back on every
+    # rerun without stashing them in session_state
+    rng = random.Random(hash((card.key, st.session_state.round_id)))
+    options = {correct}
+    norm_correct = normalize(correct)
+    pool = pools_by_tense(selected_verbs, tuple(TENSES_ALL))[card.tense]
+    for form, norm in rng.sample(pool, k=min(len(pool), 16)):
+        if len(options) >= 4:
+            break
+        if norm != norm_correct:
+            options.add(form)
+    opts = sorted(options)
+    rng.shuffle(opts)
+    st.radio("Valitse oikea muoto", opts, index=None, key="mc_choice")
 
     if st.session_state.checked:
         if st.session_state.was_correct:
@@ -410,35 +457,18 @@ else:  # Monivalinta
 
         c1, c2 = st.columns(2)
         with c1:
-            if st.button("Seuraava"):
-                go_next()
+            st.button("Seuraava", on_click=go_next)
         with c2:
-            if st.button("Ohita tämäkin"):
-                st.session_state.progress.update(card, False)
-                save_progress(st.session_state.progress)
-                go_next()
+            st.button("Ohita tämäkin", on_click=skip_card, args=(card,))
 
     else:
+        if st.session_state.pop("mc_warning", False):
+            st.warning("Valitse jokin vaihtoehto ensin.")
         c1, c2 = st.columns(2)
         with c1:
-            if st.button("Vastaa"):
-                if "mc_choice" not in st.session_state or st.session_state.mc_choice is None:
-                    st.warning("Valitse jokin vaihtoehto ensin.")
-                else:
-                    pick = st.session_state.mc_choice
-                    is_ok = normalize(pick) == normalize(correct)
-                    st.session_state.was_correct = is_ok
-                    st.session_state.last_correct_form = correct
-                    st.session_state.progress.update(card, is_ok)
-                    save_progress(st.session_state.progress)
-                    st.session_state.checked = True
-                    if is_ok:
-                        st.session_state.correct_count += 1
+            st.button("Vastaa", on_click=check_choice, args=(card, correct))
         with c2:
-            if st.button("Ohita"):
-                st.session_state.progress.update(card, False)
-                save_progress(st.session_state.progress)
-                go_next()
+            st.button("Ohita", on_click=skip_card, args=(card,))
 
 st.caption("Aksentit voi jättää pois: 'è' ≈ 'e'. Edistyminen tallentuu paikallisesti progress.json -tiedostoon.")
 